@@ -1,7 +1,9 @@
+import importlib.metadata
 import logging
 import os
 from typing import Annotated, Optional
 import vtk
+import qt
 import slicer
 from slicer.i18n import tr as _
 from slicer.i18n import translate
@@ -13,10 +15,22 @@ from slicer.parameterNodeWrapper import (
 )
 from slicer import vtkMRMLScalarVolumeNode
 from DICOMLib import DICOMUtils
-slicer.util.pip_install("--ignore-requires-python pytomography==3.0.0")
+
+PYTOMOGRAPHY_VERSION = "3.0.0"
+
+def _ensure_pytomography():
+    """Install pytomography only if the required version is not already available."""
+    # Check the installed distribution without importing it, so a mismatched version is never loaded
+    try:
+        if importlib.metadata.version("pytomography") == PYTOMOGRAPHY_VERSION:
+            return
+    except importlib.metadata.PackageNotFoundError:
+        pass
+    slicer.util.pip_install(f"--ignore-requires-python pytomography=={PYTOMOGRAPHY_VERSION}")
+
+_ensure_pytomography()
 import pytomography
-print(pytomography.__version__)
-print("I'm here")
+logging.debug(f"Using pytomography {pytomography.__version__}")
 from pytomography.io.SPECT import dicom, simind
 from pytomography.io.shared import dicom_creation
 from pytomography.transforms.SPECT import SPECTAttenuationTransform, SPECTPSFTransform
@@ -24,13 +38,14 @@ from pytomography.projectors.SPECT import SPECTSystemMatrix
 from pytomography.likelihoods import PoissonLogLikelihood
 from pytomography.algorithms import OSEM, BSREM, OSMAPOSL
 from pytomography.priors import RelativeDifferencePrior, QuadraticPrior, LogCoshPrior, TopNAnatomyNeighbourWeight
+from pytomography.callbacks import Callback
 import numpy as np
 import pydicom
 import torch
-import tempfile
-import shutil
 import re
 import copy
+from functools import partial
+from operator import itemgetter
 from pathlib import Path
 from pydicom.dataset import Dataset
 from pydicom.sequence import Sequence
@@ -72,6 +87,8 @@ class SlicerSPECTReconWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self._parameterNode = None
         self._updatingGUIFromParameterNode = False
         self._projectionList = None
+        self._energyWindows = None
+        self._energyWindowIndex = {}
 
     def setup(self):
         """
@@ -109,18 +126,19 @@ class SlicerSPECTReconWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.ui.simind_randomseed_spinBox.connect('valueChanged(int)', self.changeSIMINDFolderStudyDescription)
         self.ui.simind_poisson_checkBox.connect('toggled(bool)', self.hideShowItems)
         # Update info
-        self.ui.NM_data_selector.connect('checkedNodesChanged()', self.updateParameterNodeFromGUI)
-        self.ui.attenuationdata.connect('currentNodeChanged(vtkMRMLNode*)', self.updateParameterNodeFromGUI)
-        self.ui.anatomyPriorImageNode.connect('currentNodeChanged(vtkMRMLNode*)', self.updateParameterNodeFromGUI)
-        self.ui.spect_collimator_combobox.connect('currentTextChanged(QString)', self.updateParameterNodeFromGUI)
-        self.ui.spect_scatter_combobox.connect('currentTextChanged(QString)', self.updateParameterNodeFromGUI)
-        self.ui.photopeak_combobox.connect('currentTextChanged(QString)', self.updateParameterNodeFromGUI)
-        self.ui.spect_upperwindow_combobox.connect('currentTextChanged(QString)', self.updateParameterNodeFromGUI)
-        self.ui.spect_lowerwindow_combobox.connect('currentTextChanged(QString)', self.updateParameterNodeFromGUI)
-        self.ui.IntrinsicResolutionSpinBox.connect('valueChanged(float)', self.updateParameterNodeFromGUI)
-        self.ui.osem_iterations_spinbox.connect('valueChanged(int)', self.updateParameterNodeFromGUI)
-        self.ui.osem_subsets_spinbox.connect('valueChanged(int)', self.updateParameterNodeFromGUI)
-        self.ui.outputVolumeSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.updateParameterNodeFromGUI)
+        # Each widget only writes its own parameter
+        self.ui.NM_data_selector.connect('checkedNodesChanged()', self.updateProjectionListFromGUI)
+        self.ui.attenuationdata.connect('currentNodeChanged(vtkMRMLNode*)', partial(self.updateNodeReferenceFromGUI, "AttenuationData"))
+        self.ui.anatomyPriorImageNode.connect('currentNodeChanged(vtkMRMLNode*)', partial(self.updateNodeReferenceFromGUI, "AnatomyPriorImage"))
+        self.ui.spect_collimator_combobox.connect('currentTextChanged(QString)', partial(self.updateParameterFromGUI, "Collimator"))
+        self.ui.spect_scatter_combobox.connect('currentTextChanged(QString)', partial(self.updateParameterFromGUI, "Scatter"))
+        self.ui.photopeak_combobox.connect('currentTextChanged(QString)', partial(self.updateParameterFromGUI, "Photopeak"))
+        self.ui.spect_upperwindow_combobox.connect('currentTextChanged(QString)', partial(self.updateParameterFromGUI, "UpperWindow"))
+        self.ui.spect_lowerwindow_combobox.connect('currentTextChanged(QString)', partial(self.updateParameterFromGUI, "LowerWindow"))
+        self.ui.algorithm_selector_combobox.connect('currentTextChanged(QString)', partial(self.updateParameterFromGUI, "Algorithm"))
+        self.ui.osem_iterations_spinbox.connect('valueChanged(int)', partial(self.updateParameterFromGUI, "Iterations"))
+        self.ui.osem_subsets_spinbox.connect('valueChanged(int)', partial(self.updateParameterFromGUI, "Subsets"))
+        self.ui.outputVolumeSelector.connect('currentNodeChanged(vtkMRMLNode*)', lambda node: self.updateParameterFromGUI("OutputVolume", node.GetID() if node else ""))
         # Default values
         self.ui.data_converters_CollapsibleButton.checked = False
         self.ui.AttenuationGroupBox.setVisible(self.ui.attenuation_toggle.checked)
@@ -155,6 +173,9 @@ class SlicerSPECTReconWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         """Called just before the scene is closed."""
         # Parameter node will be reset, do not use it anymore
         self.setParameterNode(None)
+        # Energy windows of the closed scene's projection data no longer apply
+        self._energyWindows = None
+        self._energyWindowIndex = {}
         
 
     def onSceneEndClose(self, caller, event) -> None:
@@ -230,7 +251,6 @@ class SlicerSPECTReconWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.ui.simind_studydescription_lineEdit.text = f'{name}_time{time:.0f}_scale{scale:.0f}_seed{random_seed}'
             
     def hideShowItems(self, called=None, event=None):
-        print(self.ui.attenuation_toggle.checked)
         self.ui.AttenuationGroupBox.setVisible(self.ui.attenuation_toggle.checked)
         self.ui.PSFGroupBox.setVisible(self.ui.psf_toggle.checked)
         self.ui.ScatterGroupBox.setVisible(self.ui.scatter_toggle.checked)
@@ -284,71 +304,87 @@ class SlicerSPECTReconWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         """
         if self._updatingGUIFromParameterNode:
             return
-        print('update')
-        # Make sure GUI changes do not call updateParameterNodeFromGUI (it could cause infinite loop)
+        # Make sure GUI changes are not written back to the parameter node (it could cause infinite loop)
         self._updatingGUIFromParameterNode = True
         inputVolume1 = self._parameterNode.GetNodeReference("InputVolume1")
         if inputVolume1 and self._parameterNode.GetParameter("Photopeak") :
             self.getProjectionData(inputVolume1)
-        last_text = {}
-        lastUpperWindowSelection = last_text.get(self.ui.spect_upperwindow_combobox.objectName, "None")
-        lastLowerWindowSelection = last_text.get(self.ui.spect_lowerwindow_combobox.objectName, "None")
         # Update photopeak
         photopeak_value = self._parameterNode.GetParameter("Photopeak")
-        photopeak_index = self.ui.photopeak_combobox.findText(photopeak_value)
+        photopeak_index = self._energyWindowComboboxIndex(self.ui.photopeak_combobox, photopeak_value)
         self.ui.photopeak_combobox.setCurrentIndex(photopeak_index)
-        last_text[self.ui.photopeak_combobox.objectName] = self.ui.photopeak_combobox.currentText
-        print(f'Photopeak: {photopeak_value}')
-        print(f'Photopeak Index: {photopeak_index}')
-        print(photopeak_index)
+        logging.debug(f'Photopeak: {photopeak_value} (index {photopeak_index})')
         # Attenuation Stuff
         # Scatter Stuff
         if self.ui.scatter_toggle.checked:
-            if self.ui.spect_upperwindow_combobox.currentText != lastUpperWindowSelection:
+            if self.ui.spect_upperwindow_combobox.currentText != "None":
                 upperwindow_value = self._parameterNode.GetParameter("UpperWindow")
-                upperwindow_index = self.ui.spect_upperwindow_combobox.findText(upperwindow_value)
+                upperwindow_index = self._energyWindowComboboxIndex(self.ui.spect_upperwindow_combobox, upperwindow_value)
                 self.ui.spect_upperwindow_combobox.setCurrentIndex(upperwindow_index)
-                last_text[self.ui.spect_upperwindow_combobox.objectName] = self.ui.spect_upperwindow_combobox.currentText
-            if self.ui.spect_lowerwindow_combobox.currentText != lastLowerWindowSelection:
+            if self.ui.spect_lowerwindow_combobox.currentText != "None":
                 lowerwindow_value = self._parameterNode.GetParameter("LowerWindow")
-                lowerwindow_index = self.ui.spect_lowerwindow_combobox.findText(lowerwindow_value)
+                lowerwindow_index = self._energyWindowComboboxIndex(self.ui.spect_lowerwindow_combobox, lowerwindow_value)
                 self.ui.spect_lowerwindow_combobox.setCurrentIndex(lowerwindow_index)
-                last_text[self.ui.spect_lowerwindow_combobox.objectName] = self.ui.spect_lowerwindow_combobox.currentText
         if inputVolume1:
             self.ui.outputVolumeSelector.baseName = inputVolume1.GetName() + " reconstructed"
         
         # All the GUI updates are done
         self._updatingGUIFromParameterNode = False
 
-    def updateParameterNodeFromGUI(self, caller=None, event=None):
+    def _energyWindowComboboxIndex(self, combobox, text):
+        """Index of an energy window in its combobox, falling back to findText before projection data is loaded."""
+        if self._energyWindowIndex:
+            return self._energyWindowIndex.get(text, -1)
+        return combobox.findText(text)
+
+    def updateProjectionListFromGUI(self):
         """
-        This method is called when the user makes any change in the GUI.
-        The changes are saved into the parameter node (so that they are restored when the scene is saved and loaded).
+        Save the checked projection volumes into the parameter node.
         """
         if self._parameterNode is None or self._updatingGUIFromParameterNode:
             return
-        wasModified = self._parameterNode.StartModify()  # Modify all properties in a single batch
+        wasModified = self._parameterNode.StartModify()
         self._projectionList = self.ui.NM_data_selector.checkedNodes()
         for counter, node in enumerate(self._projectionList, start=1):
             if node:
-                nodeID = node.GetID()
-                self._parameterNode.SetNodeReferenceID(f"InputVolume{counter}", nodeID)  
-        self._parameterNode.SetNodeReferenceID("AttenuationData", self.ui.attenuationdata.currentNodeID)
-        self._parameterNode.SetNodeReferenceID("AnatomyPriorImage", self.ui.anatomyPriorImageNode.currentNodeID)
-        self._parameterNode.SetParameter("Collimator", self.ui.spect_collimator_combobox.currentText)
-        self._parameterNode.SetParameter("Scatter", self.ui.spect_scatter_combobox.currentText)
-        self._parameterNode.SetParameter("Photopeak", str(self.ui.photopeak_combobox.currentText))
-        self._parameterNode.SetParameter("UpperWindow", self.ui.spect_upperwindow_combobox.currentText)
-        self._parameterNode.SetParameter("LowerWindow", self.ui.spect_lowerwindow_combobox.currentText)
-        self._parameterNode.SetParameter("Algorithm", self.ui.algorithm_selector_combobox.currentText)
-        self._parameterNode.SetParameter("Iterations", str(self.ui.osem_iterations_spinbox.value))
-        self._parameterNode.SetParameter("Subsets", str(self.ui.osem_subsets_spinbox.value))
-        self._parameterNode.SetParameter("OutputVolume", self.ui.outputVolumeSelector.currentNodeID)
+                self._setNodeReferenceID(f"InputVolume{counter}", node.GetID())
         self._parameterNode.EndModify(wasModified)
 
+    def updateParameterFromGUI(self, name, value):
+        """
+        Save a single GUI value into the parameter node.
+        """
+        if self._parameterNode is None or self._updatingGUIFromParameterNode:
+            return
+        self._setParameter(name, str(value))
+
+    def updateNodeReferenceFromGUI(self, role, node):
+        """
+        Save a single GUI node selection into the parameter node.
+        """
+        if self._parameterNode is None or self._updatingGUIFromParameterNode:
+            return
+        self._setNodeReferenceID(role, node.GetID() if node else None)
+
+    def _setParameter(self, name, value):
+        """Write a parameter only if its value changed, to avoid needless Modified events."""
+        if self._parameterNode.GetParameter(name) != value:
+            self._parameterNode.SetParameter(name, value)
+
+    def _setNodeReferenceID(self, role, nodeID):
+        """Write a node reference only if it points to a different node."""
+        if self._parameterNode.GetNodeReferenceID(role) != nodeID:
+            self._parameterNode.SetNodeReferenceID(role, nodeID)
+
     def getProjectionData(self,node):
         inputdatapath = self.logic.pathFromNode(node)
+        # getEnergyWindow is cached per (path, mtime, size); only rebuild the comboboxes when the windows change
         energy_window,_,_ = self.logic.getEnergyWindow(inputdatapath)
+        if energy_window == self._energyWindows:
+            return
+        self._energyWindows = energy_window
+        # The three window comboboxes share the same items, so one text->index map serves them all
+        self._energyWindowIndex = {text: index for index, text in enumerate(energy_window)}
         self.ui.spect_upperwindow_combobox.clear()
         self.ui.spect_upperwindow_combobox.addItems(energy_window)
         self.ui.spect_lowerwindow_combobox.clear()
@@ -372,27 +408,46 @@ class SlicerSPECTReconWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         elif self.ui.spect_scatter_combobox.currentText=='Triple Energy Window':
             upper_window_idx = self.ui.spect_upperwindow_combobox.currentIndex
             lower_window_idx = self.ui.spect_lowerwindow_combobox.currentIndex
-        recon_array, fileNMpaths= self.logic.reconstruct( 
-            NM_nodes = self._projectionList,
-            attenuation_toggle = self.ui.attenuation_toggle.checked,
-            ct_file = self.ui.attenuationdata.currentNode(),
-            psf_toggle = self.ui.psf_toggle.checked,
-            collimator = self.ui.spect_collimator_combobox.currentText, 
-            intrinsic_resolution = self.ui.IntrinsicResolutionSpinBox.value,
-            peak_window_idx = self.ui.photopeak_combobox.currentIndex, 
-            upper_window_idx = upper_window_idx,
-            lower_window_idx = lower_window_idx,
-            algorithm = self.ui.algorithm_selector_combobox.currentText,
-            prior_type = self.ui.priorFunctionSelector.currentText,
-            prior_beta = self.ui.priorBetaSpinBox.value,
-            prior_delta = self.ui.priorDeltaSpinBox.value,
-            prior_gamma = self.ui.priorGammaSpinBox.value,
-            prior_anatomy_image_file=self.ui.anatomyPriorImageNode.currentNode(),
-            N_prior_anatomy_nearest_neighbours = self.ui.nearestNeighboursSpinBox.value,
-            iter = self.ui.osem_iterations_spinbox.value, 
-            subset = self.ui.osem_subsets_spinbox.value
-    )
-        self.logic.stitchMultibed(recon_array, fileNMpaths, self.ui.outputVolumeSelector.currentNode())
+        # The step count comes from reconstruct through the progress callback
+        progressDialog = slicer.util.createProgressDialog(
+            labelText="Reconstructing...", maximum=0, windowTitle="SlicerSPECTRecon",
+            windowModality=qt.Qt.ApplicationModal)
+        # Reconstruction cannot be interrupted, so do not offer a cancel button
+        progressDialog.setCancelButton(None)
+        def updateProgress(step, n_steps, bed_idx, n_beds):
+            progressDialog.labelText = f"Reconstructing bed position {bed_idx+1} of {n_beds}..."
+            progressDialog.maximum = n_steps
+            progressDialog.value = step
+            slicer.app.processEvents()
+        # processEvents runs during reconstruction, so block re-entry until the result is displayed
+        self.ui.osem_reconstruct_pushbutton.enabled = False
+        try:
+            recon_array, fileNMpaths= self.logic.reconstruct( 
+                NM_nodes = self._projectionList,
+                attenuation_toggle = self.ui.attenuation_toggle.checked,
+                ct_file = self.ui.attenuationdata.currentNode(),
+                psf_toggle = self.ui.psf_toggle.checked,
+                collimator = self.ui.spect_collimator_combobox.currentText, 
+                intrinsic_resolution = self.ui.IntrinsicResolutionSpinBox.value,
+                peak_window_idx = self.ui.photopeak_combobox.currentIndex, 
+                upper_window_idx = upper_window_idx,
+                lower_window_idx = lower_window_idx,
+                algorithm = self.ui.algorithm_selector_combobox.currentText,
+                prior_type = self.ui.priorFunctionSelector.currentText,
+                prior_beta = self.ui.priorBetaSpinBox.value,
+                prior_delta = self.ui.priorDeltaSpinBox.value,
+                prior_gamma = self.ui.priorGammaSpinBox.value,
+                prior_anatomy_image_file=self.ui.anatomyPriorImageNode.currentNode(),
+                N_prior_anatomy_nearest_neighbours = self.ui.nearestNeighboursSpinBox.value,
+                iter = self.ui.osem_iterations_spinbox.value, 
+                subset = self.ui.osem_subsets_spinbox.value,
+                progress_callback = updateProgress
+            )
+            self.logic.stitchMultibed(recon_array, fileNMpaths, self.ui.outputVolumeSelector.currentNode())
+            slicer.util.setSliceViewerLayers(background=self.ui.outputVolumeSelector.currentNode(), fit=True)
+        finally:
+            progressDialog.close()
+            self.ui.osem_reconstruct_pushbutton.enabled = True
 
 class SlicerSPECTReconLogic(ScriptedLoadableModuleLogic):
     """This class should implement all the actual
@@ -408,6 +463,12 @@ class SlicerSPECTReconLogic(ScriptedLoadableModuleLogic):
         Called when the logic class is instantiated. Can be used for initializing member variables.
         """
         ScriptedLoadableModuleLogic.__init__(self)
+        self._energyWindowCache = {}
+        self._psfMetaCache = {}
+        # Projections of the most recently reconstructed files, and scatter estimates derived from them
+        self._projectionsKey = None
+        self._projections = None
+        self._scatterCache = {}
 
     def simind2DICOMProjections(
             self,
@@ -607,22 +668,27 @@ class SlicerSPECTReconLogic(ScriptedLoadableModuleLogic):
 
 
     def getEnergyWindow(self, directory):
-        # Import
-        import numpy as np
-        import pydicom
-        # Implementation
-        ds = pydicom.read_file(directory)
-        window_names =[]
-        mean_window_energies = []
-        for energy_window_information in ds.EnergyWindowInformationSequence:
-            lower_limit = energy_window_information.EnergyWindowRangeSequence[0].EnergyWindowLowerLimit
-            upper_limit = energy_window_information.EnergyWindowRangeSequence[0].EnergyWindowUpperLimit
+        key = (directory, os.path.getmtime(directory), os.path.getsize(directory))
+        if key in self._energyWindowCache:
+            return self._energyWindowCache[key]
+        ds = pydicom.dcmread(directory, stop_before_pixels=True)
+        # One (mean energy, DICOM index, name) row per window, sorted by energy
+        windows = []
+        for idx, energy_window_information in enumerate(ds.EnergyWindowInformationSequence):
+            energy_window_range = energy_window_information.EnergyWindowRangeSequence[0]
+            lower_limit = energy_window_range.EnergyWindowLowerLimit
+            upper_limit = energy_window_range.EnergyWindowUpperLimit
             energy_window_name = 'blank'#energy_window_information.EnergyWindowName
-            mean_window_energies.append((lower_limit+upper_limit)/2)
-            window_names.append(f'{energy_window_name} ({lower_limit:.2f}keV - {upper_limit:.2f}keV)')
-        idx_sorted = np.argsort(mean_window_energies)
-        window_names = list(np.array(window_names)[idx_sorted])
-        mean_window_energies = list(np.array(mean_window_energies)[idx_sorted])
+            windows.append((
+                float(lower_limit+upper_limit)/2,
+                idx,
+                f'{energy_window_name} ({lower_limit:.2f}keV - {upper_limit:.2f}keV)'
+            ))
+        windows.sort(key=itemgetter(0))
+        mean_window_energies = [window[0] for window in windows]
+        idx_sorted = [window[1] for window in windows]
+        window_names = [window[2] for window in windows]
+        self._energyWindowCache[key] = (window_names, mean_window_energies, idx_sorted)
         return window_names, mean_window_energies, idx_sorted
 
     def pathFromNode(self, node):
@@ -655,6 +721,8 @@ class SlicerSPECTReconLogic(ScriptedLoadableModuleLogic):
         """
         if not parameterNode.GetParameter("Collimator"):
             parameterNode.SetParameter("Collimator", "Choose Collimator")
+        if not parameterNode.GetParameter("Photopeak"):
+            parameterNode.SetParameter("Photopeak", "None")
         if not parameterNode.GetParameter("Scatter"):
             parameterNode.SetParameter("Scatter", "Select Scatter Window")
         if not parameterNode.GetParameter("UpperWindow"):
@@ -668,6 +736,12 @@ class SlicerSPECTReconLogic(ScriptedLoadableModuleLogic):
         if not parameterNode.GetParameter("Subsets"):
             parameterNode.SetParameter("Subsets", "0")
 
+    def getPSFMeta(self, collimator, energy_keV, intrinsic_resolution):
+        key = (collimator, energy_keV, intrinsic_resolution)
+        if key not in self._psfMetaCache:
+            self._psfMetaCache[key] = dicom.get_psfmeta_from_scanner_params(collimator, energy_keV, intrinsic_resolution=intrinsic_resolution)
+        return self._psfMetaCache[key]
+
     def get_filesNM_from_NMNodes(self, NM_nodes):
         files_NM = []
         for NM_node in NM_nodes:
@@ -678,16 +752,32 @@ class SlicerSPECTReconLogic(ScriptedLoadableModuleLogic):
     def get_metadata_photopeak_scatter(self, bed_idx, files_NM, index_peak, index_lower=None, index_upper=None):
         file_NM = files_NM[bed_idx]
         object_meta, proj_meta = dicom.get_metadata(file_NM, index_peak)
-        projectionss = dicom.load_multibed_projections(files_NM)
+        projectionss = self.loadMultibedProjections(files_NM)
         photopeak = projectionss[bed_idx][index_peak]
         # No scatter
         if (index_lower is None)*(index_upper is None):
             scatter = None
         # Dual or triple energy window
         else:
-            scatter = dicom.get_energy_window_scatter_estimate_projections(file_NM, projectionss[bed_idx], index_peak, index_lower, index_upper)
+            key = (bed_idx, index_peak, index_lower, index_upper)
+            if key not in self._scatterCache:
+                self._scatterCache[key] = dicom.get_energy_window_scatter_estimate_projections(file_NM, projectionss[bed_idx], index_peak, index_lower, index_upper)
+            scatter = self._scatterCache[key]
         return object_meta, proj_meta, photopeak, scatter
 
+    def loadMultibedProjections(self, files_NM):
+        """
+        Load projections for all bed positions, reusing the previous load if the files are unchanged.
+        Only the latest set is kept so repeated reconstructions (e.g. iteration/subset sweeps) do not
+        accumulate projection data in memory.
+        """
+        key = tuple((file_NM, os.path.getmtime(file_NM)) for file_NM in files_NM)
+        if key != self._projectionsKey:
+            self._projections = dicom.load_multibed_projections(files_NM)
+            self._projectionsKey = key
+            self._scatterCache = {}
+        return self._projections
+
     def reconstruct(
         self,
         NM_nodes,
@@ -707,7 +797,8 @@ class SlicerSPECTReconLogic(ScriptedLoadableModuleLogic):
         prior_anatomy_image_file,
         N_prior_anatomy_nearest_neighbours,
         iter,
-        subset
+        subset,
+        progress_callback=None
     ): 
         
         # Get data/metadata
@@ -716,22 +807,30 @@ class SlicerSPECTReconLogic(ScriptedLoadableModuleLogic):
         index_peak = idx_sorted[peak_window_idx]
         index_upper = idx_sorted[upper_window_idx] if upper_window_idx is not None else None
         index_lower = idx_sorted[lower_window_idx] if lower_window_idx is not None else None
-        print(index_upper)
-        print(index_lower)
+        logging.debug(f'Scatter window indices: upper={index_upper}, lower={index_lower}')
+        # CT file lists are the same for every bed position
+        files_CT = self.filesFromNode(ct_file) if attenuation_toggle else None
+        files_prior_anatomy = self.filesFromNode(prior_anatomy_image_file) if prior_type!='None' else None
+        if psf_toggle:
+            # mean_window_energies is sorted like the combobox, so index it by combobox position
+            psf_meta = self.getPSFMeta(collimator, mean_window_energies[peak_window_idx], intrinsic_resolution)
         # Loop over and reconstruct all bed positions
         recon_array = []
-        for bed_idx in range(len(files_NM)):
+        n_beds = len(files_NM)
+        for bed_idx in range(n_beds):
+            if progress_callback is not None:
+                progress_callback(bed_idx*iter*subset, n_beds*iter*subset, bed_idx, n_beds)
+                callback = ReconstructionProgressCallback(progress_callback, bed_idx, n_beds, iter, subset)
+            else:
+                callback = None
             object_meta, proj_meta, photopeak, scatter = self.get_metadata_photopeak_scatter(bed_idx, files_NM, index_peak, index_lower, index_upper)
             # Transforms used for system modeling
             obj2obj_transforms = []
             if attenuation_toggle:
-                files_CT = self.filesFromNode(ct_file)
                 attenuation_map = dicom.get_attenuation_map_from_CT_slices(files_CT, files_NM[bed_idx], index_peak)
                 att_transform = SPECTAttenuationTransform(attenuation_map)
                 obj2obj_transforms.append(att_transform)
             if psf_toggle:
-                peak_window_energy = mean_window_energies[index_peak]
-                psf_meta = dicom.get_psfmeta_from_scanner_params(collimator, peak_window_energy, intrinsic_resolution=intrinsic_resolution)
                 psf_transform = SPECTPSFTransform(psf_meta)
                 obj2obj_transforms.append(psf_transform)
             # Build system matrix
@@ -745,9 +844,8 @@ class SlicerSPECTReconLogic(ScriptedLoadableModuleLogic):
             if prior_type=='None':
                 prior = None
             else:
-                if prior_anatomy_image_file is not None:
-                    files_CT = self.filesFromNode(prior_anatomy_image_file)
-                    prior_anatomy_image = dicom.get_attenuation_map_from_CT_slices(files_CT, files_NM[bed_idx], keep_as_HU=True)
+                if files_prior_anatomy is not None:
+                    prior_anatomy_image = dicom.get_attenuation_map_from_CT_slices(files_prior_anatomy, files_NM[bed_idx], keep_as_HU=True)
                     prior_weight = TopNAnatomyNeighbourWeight(prior_anatomy_image, N_neighbours=N_prior_anatomy_nearest_neighbours)
                 else:
                     prior_weight = None
@@ -766,19 +864,18 @@ class SlicerSPECTReconLogic(ScriptedLoadableModuleLogic):
             elif algorithm == "OSMAPOSL":
                 reconstruction_algorithm = OSMAPOSL(likelihood, prior=prior)
             # Reconstruct
-            reconstructed_object = reconstruction_algorithm(n_iters=iter, n_subsets=subset)
+            reconstructed_object = reconstruction_algorithm(n_iters=iter, n_subsets=subset, callback=callback)
             recon_array.append(reconstructed_object)
         return recon_array, files_NM
 
     def stitchMultibed(self, recon_array, fileNMpaths, outputVolume):
         if len(fileNMpaths)>1:
             # Get top bed position
-            dss = np.array([pydicom.read_file(file_NM) for file_NM in fileNMpaths])
+            dss = [pydicom.dcmread(file_NM, stop_before_pixels=True) for file_NM in fileNMpaths]
             zs = np.array(
                 [ds.DetectorInformationSequence[0].ImagePositionPatient[-1] for ds in dss]
             )
             order = np.argsort(zs)
-            print(torch.stack(recon_array).shape)
             recon_stitched = dicom.stitch_multibed(recons=torch.stack(recon_array), files_NM = fileNMpaths)
             fileNMpath_save = fileNMpaths[order[-1]]
         else:
@@ -786,38 +883,53 @@ class SlicerSPECTReconLogic(ScriptedLoadableModuleLogic):
             fileNMpath_save = fileNMpaths[0]
         reconstructedDCMInstances = dicom.save_dcm(save_path = None, object = recon_stitched, 
                                                    file_NM = fileNMpath_save, recon_name = 'slicer_recon', return_ds =True)
-        temp_dir = tempfile.mkdtemp()
-        for i, dataset in enumerate(reconstructedDCMInstances):
-            temp_file_path = os.path.join(temp_dir, f"temp_{i}.dcm")
-            dataset.save_as(temp_file_path)
-        # Add saved files to DICOM browser
-        dicomBrowser = slicer.modules.DICOMWidget.browserWidget.dicomBrowser
-        dicomBrowser.importDirectory(temp_file_path, dicomBrowser.ImportDirectoryAddLink)
-        dicomBrowser.waitForImportFinished()
-        # Create temp database so files can be loaded in viewer
-        loadedNodeIDs = []
-        with DICOMUtils.TemporaryDICOMDatabase() as db:
-            DICOMUtils.importDicom(temp_dir, db)
-            patientUIDs = db.patients()
-            for patientUID in patientUIDs:
-                loadedNodeIDs.extend(DICOMUtils.loadPatientByUID(patientUID))
-        if loadedNodeIDs:
-            volumeNode = slicer.mrmlScene.GetNodeByID(loadedNodeIDs[0])
-        outputVolume.SetAndObserveImageData(volumeNode.GetImageData())
-        outputVolume.CreateDefaultDisplayNodes() 
-        colorTableID = volumeNode.GetDisplayNode().GetColorNodeID()
-        outputVolume.GetDisplayNode().SetAndObserveColorNodeID(colorTableID)
-        window = volumeNode.GetDisplayNode().GetWindow()
-        level = volumeNode.GetDisplayNode().GetLevel()
-        outputVolume.GetDisplayNode().SetWindow(window)
-        outputVolume.GetDisplayNode().SetLevel(level)
-        volumeMatrix = vtk.vtkMatrix4x4()
-        volumeNode.GetRASToIJKMatrix(volumeMatrix)
-        # Apply the same orientation matrix to the outputVolume
-        outputVolume.SetRASToIJKMatrix(volumeMatrix)
-        slicer.mrmlScene.RemoveNode(volumeNode)
-        shutil.rmtree(temp_dir)
-        print("Reconstruction successful")
+        # Voxels come straight from the reconstructed tensor (float, not the uint16-quantized DICOM pixels);
+        # the datasets are only used for geometry, so pytomography stays the single source of its slice layout
+        voxels = recon_stitched.permute(2,1,0).cpu().numpy().astype(np.float32)
+        self.updateVolumeFromDatasets(outputVolume, voxels, reconstructedDCMInstances)
+        outputVolume.CreateDefaultDisplayNodes()
+        logging.info("Reconstruction successful")
+
+    def updateVolumeFromDatasets(self, volumeNode, voxels, dss):
+        """
+        Set voxels of a scalar volume node, indexed [slice, row, column], and take its geometry
+        from the matching single-slice DICOM datasets held in memory.
+        """
+        dss = sorted(dss, key=lambda ds: int(ds.InstanceNumber))
+        row_cosine = np.array(dss[0].ImageOrientationPatient[:3], dtype=float)
+        col_cosine = np.array(dss[0].ImageOrientationPatient[3:], dtype=float)
+        positions = np.array([ds.ImagePositionPatient for ds in dss], dtype=float)
+        if len(dss)>1:
+            slice_step = (positions[-1] - positions[0]) / (len(dss) - 1)
+        else:
+            slice_step = np.cross(row_cosine, col_cosine) * float(dss[0].SliceThickness)
+        row_spacing, col_spacing = (float(spacing) for spacing in dss[0].PixelSpacing)
+        slicer.util.updateVolumeFromArray(volumeNode, voxels)
+        # DICOM patient coordinates are LPS, Slicer uses RAS
+        lps_to_ras = np.diag([-1, -1, 1])
+        axes = [row_cosine * col_spacing, col_cosine * row_spacing, slice_step]
+        ijkToRAS = vtk.vtkMatrix4x4()
+        for column, axis in enumerate(axes + [positions[0]]):
+            for row, value in enumerate(lps_to_ras @ axis):
+                ijkToRAS.SetElement(row, column, value)
+        volumeNode.SetIJKToRASMatrix(ijkToRAS)
+
+class ReconstructionProgressCallback(Callback):
+    """
+    pytomography callback that reports reconstruction progress after every subiteration.
+    """
+    def __init__(self, progress_callback, bed_idx, n_beds, n_iters, n_subsets):
+        super().__init__()
+        self.progress_callback = progress_callback
+        self.bed_idx = bed_idx
+        self.n_beds = n_beds
+        self.n_iters = n_iters
+        self.n_subsets = n_subsets
+
+    def run(self, object, n_iter, n_subset):
+        step = (self.bed_idx*self.n_iters + n_iter)*self.n_subsets + n_subset + 1
+        self.progress_callback(step, self.n_beds*self.n_iters*self.n_subsets, self.bed_idx, self.n_beds)
+        return object
 
 class SlicerSPECTReconTest(ScriptedLoadableModuleTest):
     """